@@ -3,15 +3,14 @@ import numpy
 import numpy as np
 import torch
 import torch.nn as nn
-import torchvision
 import functools
-from contextlib import nullcontext
+from contextlib import nullcontext, contextmanager
 import socket
 import psutil
 import humanize
 import time
-import matplotlib.pyplot as plt
 import gc
+import math
 from math import prod
 from PIL import Image
 from .common_jupyter import jupyter_gc
@@ -23,21 +22,12 @@ from pynight.common_dict import simple_obj
 from pynight.common_iterable import (
     HiddenList,
 )
-import torchvision.transforms as transforms
 
 
 # import pynight.common_dict
 
-try:
-    import jax
-except ImportError:
-    pass
-
-try:
-    from codecarbon import OfflineEmissionsTracker
-except ImportError:
-    pass
-
+#: =torchvision=, =matplotlib=, =jax= and =codecarbon= are imported lazily where they are needed, as importing them dominates the import time of this module.
+#: Hence, this module no longer exports =torchvision=, =transforms=, =plt=, =jax= or =OfflineEmissionsTracker=, and =torch_to_PIL= is only available as an attribute (not through =import *=).
 
 try:
     import nvidia_smi
@@ -51,9 +41,66 @@ torch_shape_get_hidden = set()
 torch_shape_get_hidden_ids = set()
 
 
-def torch_shape_get(input, size_p=False, type_only_p=False, device_p=True):
-    total_size = 0
+class _ShapeInfo:
+    """
+    The per-leaf result of `torch_shape_get`. Fields that do not apply are left as `None`.
+    """
+
+    __slots__ = ("dtype", "shape", "device", "size_mb", "type")
+
+    def __init__(self, dtype=None, shape=None, device=None, size_mb=None, type=None):
+        self.dtype = dtype
+        self.shape = shape
+        self.device = device
+        self.size_mb = size_mb
+        self.type = type
+
+    def empty_p(self):
+        return all(getattr(self, k) is None for k in self.__slots__)
+
+    def to_dict(self):
+        """
+        Returns the set fields as a JSON-serializable dict, i.e., with the dtype, device and type as strings, and the shape as a tuple.
+        """
+        res = dict()
+        if self.dtype is not None:
+            res["dtype"] = str(self.dtype)
+        if self.shape is not None:
+            res["shape"] = tuple(self.shape)
+        if self.device is not None:
+            res["device"] = str(self.device)
+        if self.size_mb is not None:
+            res["size_mb"] = self.size_mb
+        if self.type is not None:
+            res["type"] = self.type.__name__
+
+        return res
 
+    def __eq__(self, other):
+        if not isinstance(other, _ShapeInfo):
+            return NotImplemented
+
+        return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        parts = []
+        if self.type is not None:
+            parts.append(self.type.__name__)
+        if self.dtype is not None:
+            parts.append(str(self.dtype))
+        if self.shape is not None:
+            parts.append(str(tuple(self.shape)))
+        if self.device is not None:
+            parts.append(str(self.device))
+        if self.size_mb is not None:
+            parts.append(f"{self.size_mb:.2f}MB")
+
+        return f"ShapeInfo({', '.join(parts)})"
+
+
+def torch_shape_get(input, size_p=False, type_only_p=False, device_p=True):
     def is_leaf(x):
         #: [[https://stackoverflow.com/questions/77269443/how-to-add-custom-attributes-to-a-python-list][How to add custom attributes to a Python list? - Stack Overflow]]
         ##
@@ -67,40 +114,107 @@ def torch_shape_get(input, size_p=False, type_only_p=False, device_p=True):
             return False
 
     def h_shape_get(x):
+        #: returns (res, size)
+        ##
         if isinstance(x, dict):
-            #: handles classes inheriting from dict
-            #: a normal dict should never reach us, as it should be handled by =tree_map= itself
-            return torch_shape_get(dict(x))
-
-        nonlocal total_size
+            #: handles hidden dicts and dicts reaching us through =jax=; walked with the caller's flags
+            return walk(dict(x))
 
-        res = ()
+        size = 0
+        res = _ShapeInfo()
         if hasattr(x, "dtype"):
-            res += (x.dtype,)
+            res.dtype = x.dtype
             if hasattr(x, "shape"):
-                res += (x.shape,)
+                res.shape = x.shape
 
         elif hasattr(x, "shape"):
-            res += (type(x), x.shape)
+            res.type = type(x)
+            res.shape = x.shape
 
         if device_p and hasattr(x, "device"):
-            res += (x.device,)
+            res.device = x.device
 
-        if size_p and hasattr(x, "element_size") and hasattr(x, "nelement"):
-            size = torch_memory_tensor(x, s=2)
-            total_size += size
+        if size_p:
+            #: inlined =torch_memory_tensor(x, s=2)=, as this runs once per leaf
+            element_size = getattr(x, "element_size", None)
+            nelement = getattr(x, "nelement", None)
+            if element_size is not None and nelement is not None:
+                size = element_size() * nelement() / _UNIT_DIV[2]
 
-            res += (f"{size:.2f}MB",)
+                res.size_mb = size
 
-        if len(res) == 0:
+        if res.empty_p():
             if type_only_p or isinstance(x, HiddenList) or is_leaf(x):
                 res = type(x)
             else:
                 res = x
 
-        return res
+        return res, size
+
+    def walk(x):
+        #: returns (res, size)
+        #: Plain containers, dict subclasses, namedtuples and leaves are handled here directly; only other pytrees go through =jax=.
+        ##
+        if x is None:
+            #: =jax= treats =None= as an empty pytree.
+            return None, 0
+
+        if (
+            is_leaf(x)
+            or isinstance(x, HiddenList)
+            or not isinstance(x, (list, tuple, dict))
+        ):
+            #: tensors, NumPy arrays, images, plain objects, hidden containers, ...
+            return h_shape_get(x)
+
+        x_type = type(x)
+        total_size = 0
+        if isinstance(x, dict):
+            res = dict()
+            for k, v in x.items():
+                res[k], size = walk(v)
+                total_size += size
+
+            if x_type is not dict:
+                #: e.g., =OrderedDict= (as returned by =state_dict()=)
+                try:
+                    res = x_type(res)
+                except TypeError:
+                    #: e.g., =defaultdict=, whose first argument is its factory
+                    pass
+
+            return res, total_size
+
+        namedtuple_p = isinstance(x, tuple) and hasattr(x_type, "_fields")
+        if x_type in (list, tuple) or namedtuple_p:
+            res = []
+            for v in x:
+                v_res, size = walk(v)
+                res.append(v_res)
+                total_size += size
+
+            if namedtuple_p:
+                return x_type(*res), total_size
+            else:
+                return x_type(res), total_size
+
+        #: Other list and tuple subclasses might be registered pytrees, which only =jax= knows about.
+        try:
+            import jax
+        except ImportError:
+            return h_shape_get(x)
 
-    res = jax.tree_map(h_shape_get, input, is_leaf=is_leaf)
+        sizes = []
+
+        def h_leaf(y):
+            y_res, size = h_shape_get(y)
+            sizes.append(size)
+            return y_res
+
+        res = jax.tree_util.tree_map(h_leaf, x, is_leaf=is_leaf)
+        return res, sum(sizes)
+
+    res, total_size = walk(input)
 
     if size_p:
         # return (f"total_size: {total_size:.2f}MB", res)
@@ -134,24 +248,43 @@ class TorchModelMode:
         self.mode = mode
         self.original_mode = None
 
+        mode_lower = mode.lower()
+        if mode_lower not in ("train", "eval"):
+            raise ValueError(f"Invalid mode '{self.mode}', must be 'train' or 'eval'")
+
+        self._target_train = mode_lower == "train"
+
     def __enter__(self):
         self.original_mode = self.model.training  # Save the original mode
-        if self.mode.lower() == "train":
-            self.model.train()
-        elif self.mode.lower() == "eval":
-            self.model.eval()
-        else:
-            raise ValueError(f"Invalid mode '{self.mode}', must be 'train' or 'eval'")
+
+        #: Always applied, even when the root is already in the target mode, as its submodules might not be.
+        self.model.train(self._target_train)
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.original_mode:  # Restore the original mode
-            self.model.train()
-        else:
-            self.model.eval()
+        self.model.train(self.original_mode)  # Restore the original mode
 
 
 ##
-torch_to_PIL = torchvision.transforms.ToPILImage()
+_torch_to_PIL = None
+
+
+def _get_torch_to_PIL():
+    global _torch_to_PIL
+
+    if _torch_to_PIL is None:
+        import torchvision
+
+        _torch_to_PIL = torchvision.transforms.ToPILImage()
+
+    return _torch_to_PIL
+
+
+def __getattr__(name):
+    #: keeps =torch_to_PIL= importable without importing =torchvision= eagerly
+    if name == "torch_to_PIL":
+        return _get_torch_to_PIL()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def img_tensor_show(
@@ -159,6 +292,8 @@ def img_tensor_show(
     dpi=100,
     title=None,
 ):
+    import matplotlib.pyplot as plt
+
     if isinstance(img_tensor, Image.Image):
         image = img_tensor
     else:
@@ -172,10 +307,25 @@ def img_tensor_show(
         if img_tensor.dtype == np.bool_:
             img_tensor = img_tensor.astype(np.uint8) * 255
         ##
-        image = torch_to_PIL(img_tensor)
+        if (
+            isinstance(img_tensor, torch.Tensor)
+            and img_tensor.dtype == torch.uint8
+            and img_tensor.ndim == 3
+            and img_tensor.shape[0] in (1, 3, 4)
+        ):
+            #: =plt.imshow= only takes grey, RGB or RGBA; other channel counts (e.g., LA) go through =ToPILImage=.
+            #: uint8 CHW tensors can be shown directly, skipping the PIL round-trip (and its pixel copy).
+            image = img_tensor.detach().cpu().permute(1, 2, 0).contiguous().numpy()
+            if image.shape[-1] == 1:
+                image = image[..., 0]
+        else:
+            image = _get_torch_to_PIL()(img_tensor)
 
     # Get image dimensions
-    height, width = image.size
+    if isinstance(image, Image.Image):
+        width, height = image.size
+    else:
+        height, width = image.shape[:2]
 
     #: Set the figure size based on the image dimensions
     plt.figure(figsize=(width / dpi, height / dpi))
@@ -245,12 +395,17 @@ def gpu_memory_get(unit="GB", mode="total"):
     return memory_in_unit
 
 
+_UNIT_DIV = {0: 1, 1: 1024, 2: 1024**2, 3: 1024**3, 4: 1024**4}
+
+
 def torch_memory_tensor(tensor, s=3):
     #: s=3: gigabyte
     ##
-    size_in_bytes = tensor.element_size() * tensor.nelement()
-    size = size_in_bytes / (1024**s)
-    return size
+    unit_div = _UNIT_DIV.get(s)
+    if unit_div is None:
+        unit_div = 1024**s
+
+    return tensor.element_size() * tensor.numel() / unit_div
 
 
 def torch_gpu_empty_cache(gc_mode="full"):
@@ -275,16 +430,10 @@ def torch_gpu_remove_all():
     #: ** =gc.get_objects=
     #: Returns a list of all objects tracked by the collector, excluding the list returned. If generation is not None, return only the objects tracked by the collector that are in that generation.
     ##
-    for obj in gc.get_objects():
-        try:
-            if torch.is_tensor(obj) or (
-                hasattr(obj, "data") and torch.is_tensor(obj.data)
-            ):
-                if obj.is_cuda:
-                    del obj
-        except:
-            #: There are errors when trying to determine if these objects are tensors or not.
-            pass
+    #: There are errors when trying to determine if some of these objects are tensors or not, e.g., proxies whose `__class__` raises (which `isinstance` falls back to). `type(o)` never touches `__class__`, so this filter has no exception path. `nn.Parameter` subclasses `torch.Tensor`, so it is covered, too.
+    objs = gc.get_objects()
+    cuda_tensors = [o for o in objs if issubclass(type(o), torch.Tensor) and o.is_cuda]
+    del cuda_tensors, objs
 
     torch_gpu_empty_cache()
 
@@ -301,22 +450,244 @@ def no_grad_maybe(no_grad_p):
 
 ##
 def model_device_get(model):
-    return next(model.parameters()).device
+    """
+    Returns the device of the first parameter of `model`, or the CPU if it has none.
+    """
+    p = next(model.parameters(), None)
+    if p is None:
+        return torch.device("cpu")
+
+    return p.device
 
 
 ##
-def hash_tensor(tensor, *args, **kwargs):
+hash_tensor_fold_min_bytes = 1 << 20
+hash_tensor_fold_width = 1024
+#: in int64 words
+hash_tensor_fold_block_rows = 1024
+#: rows mixed at a time, which bounds the temporaries to a few such blocks
+
+
+def _u64_to_i64(c):
+    return c - (1 << 64) if c >= (1 << 63) else c
+
+
+#: the splitmix64 constants, as signed int64
+_FOLD_K0 = _u64_to_i64(0x9E3779B97F4A7C15)
+_FOLD_K1 = _u64_to_i64(0xBF58476D1CE4E5B9)
+_FOLD_K2 = _u64_to_i64(0x94D049BB133111EB)
+
+
+def _fold_shift_right(x, n):
+    #: logical shift; `>>` on int64 is arithmetic
+    return (x >> n).bitwise_and_((1 << (64 - n)) - 1)
+
+
+def _fold_rows_xor_(words):
+    #: XORs the rows of `words` together in place, and returns the resulting row.
+    while words.shape[0] > 1:
+        if words.shape[0] % 2:
+            words[0].bitwise_xor_(words[-1])
+            words = words[:-1]
+
+        half = words.shape[0] // 2
+        words[:half].bitwise_xor_(words[half:])
+        words = words[:half]
+
+    return words[0]
+
+
+def hash_tensor_fold(tensor, width=None):
+    """
+    Folds the raw bytes of `tensor` on its own device into `width` int64 words.
+
+    Each word is first mixed with its position (splitmix64-style), and only then are the rows XOR-ed together, so that equal rows do not cancel out and reordering rows changes the result. This is a fast checksum, not a cryptographic hash.
+
+    Besides a padded copy of the tensor, only a few blocks of `hash_tensor_fold_block_rows` rows are allocated, as the rows are mixed and folded block by block in place.
+
+    Returns:
+        torch.Tensor: A 1-D int64 tensor of length `width`.
+    """
+    width = width or hash_tensor_fold_width
+
+    flat = tensor.detach().contiguous().view(-1).view(torch.uint8)
+    device = flat.device
+
+    chunk_bytes = 8 * width
+    num_rows = max(1, -(-flat.numel() // chunk_bytes))
+
+    #: Always copying into a fresh buffer makes the int64 view safe for any storage offset (e.g., `x[1:]`), and pads the tail with zeros. The copy is also what the mixing below overwrites.
+    buffer = torch.empty(num_rows * chunk_bytes, dtype=torch.uint8, device=device)
+    buffer[: flat.numel()].copy_(flat)
+    buffer[flat.numel() :].zero_()
+
+    words = buffer.view(torch.int64).view(num_rows, width)
+
+    res = torch.zeros(width, dtype=torch.int64, device=device)
+    for start in range(0, num_rows, hash_tensor_fold_block_rows):
+        end = min(start + hash_tensor_fold_block_rows, num_rows)
+        block = words[start:end]
+
+        pos = torch.arange(
+            start * width + 1,
+            end * width + 1,
+            dtype=torch.int64,
+            device=device,
+        ).view(-1, width)
+        block.bitwise_xor_(pos.mul_(_FOLD_K0))
+        del pos
+
+        block.mul_(_FOLD_K1)
+        block.bitwise_xor_(_fold_shift_right(block, 31))
+        block.mul_(_FOLD_K2)
+        block.bitwise_xor_(_fold_shift_right(block, 29))
+
+        res.bitwise_xor_(_fold_rows_xor_(block))
+
+    return res
+
+
+_PINNED_POOL = dict()
+#: size class (a power of two, in bytes) -> list of free pinned uint8 host buffers
+pinned_pool_max_bytes = 1 << 28
+#: Released buffers that would grow the pool beyond this are freed instead.
+
+hash_tensor_pinned_min_bytes = 1 << 20
+#: Below this, allocating and copying through pinned memory gains nothing over a pageable copy.
+
+
+def _pinned_pool_bytes():
+    return sum(
+        size_class * len(buffers) for size_class, buffers in _PINNED_POOL.items()
+    )
+
+
+def _pinned_size_class(nbytes):
+    return 1 << max(0, (nbytes - 1).bit_length())
+
+
+@contextmanager
+def pinned_buffer_acquire(nbytes):
+    """
+    Lends a pinned host buffer of `nbytes` bytes from `_PINNED_POOL`, allocating one only when none is free.
+
+    Buffers are pooled by power-of-two size classes, and a view of the first `nbytes` bytes is lent. The buffer is returned to the pool on exit (unless the pool is already at `pinned_pool_max_bytes`), so it must not be used after the context.
+    """
+    size_class = _pinned_size_class(nbytes)
+
+    free_buffers = _PINNED_POOL.setdefault(size_class, [])
+    if free_buffers:
+        buffer = free_buffers.pop()
+    else:
+        buffer = torch.empty(size_class, dtype=torch.uint8, pin_memory=True)
+
+    try:
+        yield buffer[:nbytes]
+    finally:
+        if _pinned_pool_bytes() + size_class <= pinned_pool_max_bytes:
+            free_buffers.append(buffer)
+
+
+def pinned_pool_clear():
+    _PINNED_POOL.clear()
+
+
+def hash_tensor(tensor, *args, device_fold_p=False, **kwargs):
+    """
+    Hashes the raw bytes of `tensor` with `hash_array_np`.
+
+    Args:
+        device_fold_p (bool): If true, CUDA tensors larger than `hash_tensor_fold_min_bytes` are first reduced on the device by `hash_tensor_fold`, so that only a few KBs are copied to the host. The resulting digests differ from the default ones (and hence from the digest of the same tensor on the CPU), and the fold is a checksum rather than a full hash of the bytes.
+    """
+    if (
+        device_fold_p
+        and tensor.is_cuda
+        and tensor.numel() * tensor.element_size() > hash_tensor_fold_min_bytes
+    ):
+        #: The shape and dtype are hashed in, too, as the folded residue alone does not distinguish reshapes.
+        ##
+        residue = hash_tensor_fold(tensor).cpu().numpy().view(np.uint8)
+        header = np.frombuffer(
+            f"fold|{tuple(tensor.shape)}|{tensor.dtype}|".encode(),
+            dtype=np.uint8,
+        )
+        return hash_array_np(np.concatenate((header, residue)), *args, **kwargs)
+
+    if tensor.is_cuda:
+        #: Hashing the raw bytes gives the same digest as hashing `tensor.cpu().numpy()`.
+        flat = tensor.detach().contiguous().view(-1).view(torch.uint8)
+
+        if (
+            flat.numel() < hash_tensor_pinned_min_bytes
+            or _pinned_size_class(flat.numel()) > pinned_pool_max_bytes
+        ):
+            #: A buffer too large to be pooled would be pinned afresh on every call, which is slower than a pageable copy.
+            return hash_array_np(flat.cpu().numpy(), *args, **kwargs)
+
+        with pinned_buffer_acquire(flat.numel()) as pinned:
+            pinned.copy_(flat, non_blocking=True)
+            torch.cuda.current_stream(tensor.device).synchronize()
+
+            return hash_array_np(pinned.numpy(), *args, **kwargs)
+
     return hash_array_np(tensor.cpu().numpy(), *args, **kwargs)
 
 
 ##
-def prepend_value(tensor: torch.Tensor, value) -> torch.Tensor:
+def _prepend_kernel(t, v):
+    out = torch.empty((*t.shape[:-1], t.shape[-1] + 1), dtype=t.dtype, device=t.device)
+    out[..., 0] = v
+    out[..., 1:] = t
+    return out
+
+
+_prepend_kernel_compiled = None
+
+
+def _prepend_kernel_compiled_get():
+    #: compiled lazily, as even creating the wrapper imports =torch._dynamo=
+    global _prepend_kernel_compiled
+
+    if _prepend_kernel_compiled is None:
+        _prepend_kernel_compiled = torch.compile(_prepend_kernel, dynamic=True)
+
+    return _prepend_kernel_compiled
+
+
+def _pad_value_exact_p(dtype, value):
+    """
+    Whether `F.pad` can fill `dtype` with the scalar `value` exactly, and without its overflow check raising.
+    """
+    value_type = type(value)
+    if value_type not in (bool, int, float):
+        #: e.g., complex and NumPy scalars
+        return False
+
+    if value_type is int and abs(value) > 2**53:
+        #: not representable as a double
+        return False
+
+    if dtype.is_complex:
+        return False
+
+    if dtype == torch.bool:
+        return value in (0, 1)
+
+    if dtype.is_floating_point:
+        return not math.isfinite(value) or abs(value) <= torch.finfo(dtype).max
+
+    info = torch.iinfo(dtype)
+    return info.min <= value <= info.max
+
+
+def prepend_value(tensor: torch.Tensor, value, compile_p=False) -> torch.Tensor:
     """
     Returns a tensor which is the input tensor with `value` prepended to its last dimension.
 
     Args:
         tensor (torch.Tensor): The input tensor.
-        value: The value to prepend.
+        value: The value to prepend. Either a scalar, or a tensor broadcastable to `tensor.shape[:-1]` (e.g., one value per batch).
+        compile_p (bool): Whether to fuse the allocation, the fill and the copy into a single `torch.compile`d kernel when `value` is a tensor.
 
     Returns:
         torch.Tensor: The output tensor `value` prepended to its last dimension.
@@ -327,19 +698,79 @@ def prepend_value(tensor: torch.Tensor, value) -> torch.Tensor:
         tensor([[33,  2,  2,  3],
                 [33,  4,  5,  6]])
     """
-    device = tensor.device
+    if not isinstance(value, torch.Tensor):
+        if _pad_value_exact_p(tensor.dtype, value):
+            #: A single padding kernel, instead of a fill plus a copy.
+            return torch.nn.functional.pad(tensor, (1, 0), mode="constant", value=value)
+
+        #: Allocating the output once and writing into it avoids the temporary filler tensor of `torch.cat`.
+        if type(value) in (bool, int, float):
+            #: `fill_` keeps the overflow check that `as_tensor` would silently skip (e.g., `1e6` into float16).
+            out = torch.empty(
+                (*tensor.shape[:-1], tensor.shape[-1] + 1),
+                dtype=tensor.dtype,
+                device=tensor.device,
+            )
+            out[..., :1].fill_(value)
+            out[..., 1:] = tensor
+            return out
 
-    filler = torch.full(
-        (*tensor.shape[:-1], 1), fill_value=value, dtype=tensor.dtype, device=device
-    )
-    return torch.cat((filler, tensor), dim=-1)
+    #: `F.pad` only accepts a real Python scalar (as a double) as its value, so complex and NumPy scalars are converted here.
+    value = torch.as_tensor(value, dtype=tensor.dtype, device=tensor.device)
+
+    if compile_p:
+        return _prepend_kernel_compiled_get()(tensor, value)
+    else:
+        return _prepend_kernel(tensor, value)
 
 
 ##
+def _drop_tokens_core(tokens, keep_idx):
+    #: =take_along_dim= broadcasts the index over the hidden dimension itself, so no expanded index is needed as with =gather=.
+    return torch.take_along_dim(tokens, keep_idx.unsqueeze(-1), dim=1)
+
+
+def _drop_tokens_core_prefixed(tokens, keep_idx, prefix_tokens):
+    return torch.cat((prefix_tokens, _drop_tokens_core(tokens, keep_idx)), dim=1)
+
+
+_drop_tokens_core_compiled = None
+_drop_tokens_core_prefixed_compiled = None
+
+
+def _drop_tokens_compiled_get(prefixed_p):
+    #: Compiled lazily, as even creating the wrapper imports =torch._dynamo=. The prefix branch is split into two functions so that =fullgraph=True= holds.
+    #: Dynamo caches the compiled graphs per code object, and =dynamic=False= retraces (up to its recompile limit) whenever the shapes change.
+    ##
+    global _drop_tokens_core_compiled, _drop_tokens_core_prefixed_compiled
+
+    if prefixed_p:
+        if _drop_tokens_core_prefixed_compiled is None:
+            _drop_tokens_core_prefixed_compiled = torch.compile(
+                _drop_tokens_core_prefixed,
+                fullgraph=True,
+                dynamic=False,
+            )
+
+        return _drop_tokens_core_prefixed_compiled
+
+    if _drop_tokens_core_compiled is None:
+        _drop_tokens_core_compiled = torch.compile(
+            _drop_tokens_core,
+            fullgraph=True,
+            dynamic=False,
+        )
+
+    return _drop_tokens_core_compiled
+
+
 def drop_tokens(
     tokens: torch.Tensor,
     mask: torch.Tensor,
     num_prefix_tokens: int = 1,
+    ordered: bool = True,
+    compile_p: bool = False,
+    check_mask_p: bool = False,
 ) -> torch.Tensor:
     """
     Drops tokens according to the given mask and preserves the prefix tokens.
@@ -351,6 +782,12 @@ def drop_tokens(
         The mask indicating which tokens to keep.
     num_prefix_tokens: int, default = 1
         The number of prefix tokens to keep.
+    ordered: bool, default = True
+        Whether the kept tokens should preserve their original order.
+    compile_p: bool, default = False
+        Whether to run the gather (and the concatenation of the prefix tokens) through a `torch.compile`d kernel specialized for the shapes seen. Useful in training loops with fixed shapes, as changing shapes trigger recompilation.
+    check_mask_p: bool, default = False
+        Whether to check that every row of the mask keeps the same number of tokens. Without this check, a mask whose rows differ silently gives wrong output (rows keeping more tokens lose some, and rows keeping fewer get dropped ones) instead of an error.
 
     Returns:
     torch.Tensor
@@ -410,19 +847,40 @@ def drop_tokens(
 
     assert tokens.shape[:-1] == mask.shape
 
-    tokens_shape = tokens.shape
-    # ic(tokens_shape)
+    mask = (mask.to(tokens.device) != 0).to(torch.int8)
+    #: Any non-zero entry means keep, as with =mask.nonzero=. Casting directly would wrap (e.g., 256) or truncate (e.g., 0.5) some values to zero, and values above one would break the sort order below.
+    #: The gather needs its index on the device of =tokens=, while indexing with =mask.nonzero= accepted, e.g., a CPU mask for CUDA tokens.
 
-    tokens = tokens[mask.nonzero(as_tuple=True)]
-    tokens = tokens.reshape((tokens_shape[0], -1, *tokens_shape[2:]))
+    num_kept = int(mask[0].sum())
     #: @assumption For all i, `mask[i].sum()` is constant.
+    if check_mask_p and not bool((mask.sum(dim=1) == num_kept).all()):
+        raise ValueError("Inconsistent number of tokens kept across batches.")
 
-    # ic(tokens.shape)
+    if ordered:
+        #: A stable sort keeps the kept tokens in their original order, which `topk` does not guarantee for ties.
+        keep_idx = torch.sort(mask, dim=1, descending=True, stable=True).indices
+        keep_idx = keep_idx[:, :num_kept]
+    else:
+        keep_idx = mask.topk(k=num_kept, dim=1, sorted=False).indices
+    #: keep_idx: [batch, num_kept]
+
+    #: The only device sync is the scalar =num_kept= above; the selection itself has no data-dependent output shape, unlike =mask.nonzero=.
+    prefixed_p = prefix_tokens is not None
+    if compile_p:
+        core = _drop_tokens_compiled_get(prefixed_p)
+    elif prefixed_p:
+        core = _drop_tokens_core_prefixed
+    else:
+        core = _drop_tokens_core
 
-    if prefix_tokens is not None:
+    if prefixed_p:
         # ic(prefix_tokens.shape)
 
-        tokens = torch.cat((prefix_tokens, tokens), dim=1)
+        tokens = core(tokens, keep_idx, prefix_tokens)
+    else:
+        tokens = core(tokens, keep_idx)
+
+    # ic(tokens.shape)
 
     return tokens
 
@@ -471,23 +929,56 @@ def mask_to_zero(x, *, keep_indices):
 
 
 ##
-def torch_device_name_get(device=None):
-    if torch.cuda.is_available():
-        device_name = torch.cuda.get_device_name(device=device)
+@functools.lru_cache(maxsize=None)
+def _has_cuda():
+    #: Checked once, so that CPU-only runs skip the =torch.cuda= calls entirely. Not checked at import time, as initializing the CUDA runtime there slows down every importer and can break CUDA in forked workers.
+    ##
+    return torch.cuda.is_available()
+
+
+def torch_device_index_get(device=None):
+    """
+    Normalizes `device` to a CUDA device index, or -1 for the CPU.
+    """
+    if not _has_cuda():
+        return -1
+
+    if device is None:
+        return torch.cuda.current_device()
+
+    if isinstance(device, int):
+        return device
+
+    device = torch.device(device)
+    if device.type != "cuda":
+        return -1
+
+    if device.index is None:
+        return torch.cuda.current_device()
+
+    return device.index
+
+
+@functools.lru_cache(maxsize=8)
+def _torch_device_name_cached(device_index):
+    if device_index >= 0:
+        return torch.cuda.get_device_name(device=device_index)
     else:
-        device_name = "cpu"
+        return "cpu"
 
-    return device_name
+
+def torch_device_name_get(device=None):
+    return _torch_device_name_cached(torch_device_index_get(device))
 
 
 ##
-def host_info_get(device=None):
-    #: @deprecated
-    #: @alt ${NIGHTDIR}/python/system_info.py
+@functools.lru_cache(maxsize=8)
+def _host_info_cached(device_index):
+    #: These facts do not change during the lifetime of the process, and =get_device_properties= is a CUDA runtime call.
     ##
     metadata = dict()
 
-    device_name = torch_device_name_get(device=device)
+    device_name = _torch_device_name_cached(device_index)
 
     hostname = socket.gethostname()
 
@@ -499,8 +990,8 @@ def host_info_get(device=None):
     metadata["total_ram_gb"] = total_ram_gb
     metadata["hostname"] = hostname
 
-    try:
-        device_properties = torch.cuda.get_device_properties(device)
+    if device_index >= 0:
+        device_properties = torch.cuda.get_device_properties(device_index)
         device_properties_dict = {
             "name": device_properties.name,
             "major": device_properties.major,
@@ -513,9 +1004,19 @@ def host_info_get(device=None):
             "multi_processor_count": device_properties.multi_processor_count,
         }
         metadata["device_properties"] = device_properties_dict
-    except:
-        traceback_print()
-        print("Continuing despite the error ...", file=sys.stderr)
+
+    return metadata
+
+
+def host_info_get(device=None):
+    #: @deprecated
+    #: @alt ${NIGHTDIR}/python/system_info.py
+    ##
+    metadata = dict(_host_info_cached(torch_device_index_get(device)))
+    #: copied so that callers can not mutate the cache
+
+    if "device_properties" in metadata:
+        metadata["device_properties"] = dict(metadata["device_properties"])
 
     return metadata
 
@@ -533,8 +1034,13 @@ class TorchBenchmarker:
         output_dir=None,
         output_file="emissions.csv",
         output_append_p=False,
+        collect_peak_memory_p=True,
+        collect_memory_stats_p=False,
+        #: =memory_stats_as_nested_dict= is a heavier CUDA call producing hundreds of counters, so it is opt-in.
     ):
         self.device = device
+        self.cuda_p = torch_device_index_get(device) >= 0
+        #: Whether the benchmarked device is a CUDA one; the CUDA syncs and memory counters are skipped otherwise (e.g., for =device="cpu"= on a CUDA host).
         self.metadata = output_dict
 
         self.measure_carbon_p = measure_carbon_p
@@ -543,16 +1049,22 @@ class TorchBenchmarker:
         self.output_dir = output_dir
         self.output_file = output_file
         self.output_append_p = output_append_p
+        self.collect_peak_memory_p = collect_peak_memory_p
+        self.collect_memory_stats_p = collect_memory_stats_p
 
         # self.tracker = None
-        # self.start_time = None
-        # self.end_time = None
+        # self.start_ns = None
+        # self.end_ns = None
         # self.max_memory_allocated = None
 
     def __enter__(self):
-        torch.cuda.reset_peak_memory_stats(device=self.device)
+        if self.cuda_p and self.collect_peak_memory_p:
+            torch.cuda.reset_peak_memory_stats(device=self.device)
 
         if self.measure_carbon_p:
+            from codecarbon import OfflineEmissionsTracker
+
+            #: A fresh tracker per run: codecarbon trackers can not be restarted (a second =start()= is a no-op, and =stop()= does not reset the accumulated energy), so a shared tracker would report cumulative emissions.
             self.tracker = OfflineEmissionsTracker(
                 country_iso_code=self.country_iso_code,
                 tracking_mode=self.tracking_mode,
@@ -562,28 +1074,42 @@ class TorchBenchmarker:
             )
             self.tracker.start()
 
-        self.start_time = time.time()
+        #: Without the sync, queued GPU work would be attributed to whatever runs after the benchmark.
+        if self.cuda_p:
+            torch.cuda.synchronize(self.device)
+
+        self.start_ns = time.perf_counter_ns()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         device = self.device
 
-        self.end_time = time.time()
-        time_taken = self.end_time - self.start_time
+        if self.cuda_p:
+            torch.cuda.synchronize(self.device)
+
+        self.end_ns = time.perf_counter_ns()
+        time_taken = (self.end_ns - self.start_ns) * 1e-9
         time_taken_humanized = humanize.precisedelta(time_taken)
         self.metadata["time_total"] = time_taken
         self.metadata["time_total_humanized"] = time_taken_humanized
 
-        self.max_memory_allocated = torch.cuda.max_memory_allocated(device=self.device)
-        max_memory_allocated_humanized = humanize.naturalsize(
-            self.max_memory_allocated,
-            binary=True,
-        )
-        self.metadata["max_memory_allocated"] = self.max_memory_allocated
-        self.metadata["max_memory_allocated_humanized"] = max_memory_allocated_humanized
-        self.metadata["memory_stats"] = torch.cuda.memory_stats_as_nested_dict(
-            device=device
-        )
+        if self.cuda_p and self.collect_peak_memory_p:
+            self.max_memory_allocated = torch.cuda.max_memory_allocated(
+                device=self.device
+            )
+            max_memory_allocated_humanized = humanize.naturalsize(
+                self.max_memory_allocated,
+                binary=True,
+            )
+            self.metadata["max_memory_allocated"] = self.max_memory_allocated
+            self.metadata["max_memory_allocated_humanized"] = (
+                max_memory_allocated_humanized
+            )
+
+        if self.cuda_p and self.collect_memory_stats_p:
+            self.metadata["memory_stats"] = torch.cuda.memory_stats_as_nested_dict(
+                device=device
+            )
 
         if self.measure_carbon_p:
             if not self.output_append_p:
@@ -602,24 +1128,21 @@ def tensorify_scalars(argnums=(0,)):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Store the original types of the arguments specified by argnums
-            original_types = {
-                argnum: torch.is_tensor(args[argnum]) for argnum in argnums
-            }
-
-            # Convert those arguments to tensors if they're not already
+            # Convert the arguments specified by argnums to tensors if they're not already
             new_args = list(args)
+            converted_p = False
             for argnum in argnums:
-                if not original_types[argnum]:
-                    new_args[argnum] = torch.tensor(args[argnum])
+                arg = args[argnum]
+                if not isinstance(arg, torch.Tensor):
+                    new_args[argnum] = torch.as_tensor(arg)
+                    converted_p = True
 
             # Call the original function
             result = func(*new_args, **kwargs)
 
-            # If the original type of an argument was not a tensor, convert the result back to the same type
-            for argnum in original_types.keys():
-                if not original_types[argnum]:
-                    return result.item()
+            # If any of those arguments was not a tensor, convert the result back to a scalar
+            if converted_p:
+                return result.item()
 
             return result
 
@@ -986,19 +1509,22 @@ def scale_patch_to_pixel(
 
 
 ##
-def swap_interpolation_to(
-    transform, interpolation=transforms.InterpolationMode.NEAREST
-):
+def swap_interpolation_to(transform, interpolation=None):
     """
     Swap the interpolation mode of torchvision transforms to the specified mode.
 
     Args:
     - transform (transforms.Compose): The torchvision Compose transform.
-    - interpolation (transforms.InterpolationMode): The desired interpolation mode.
+    - interpolation (transforms.InterpolationMode): The desired interpolation mode. Defaults to `transforms.InterpolationMode.NEAREST`.
 
     Returns:
     - transforms.Compose: The modified Compose transform with the updated interpolation mode.
     """
+    import torchvision.transforms as transforms
+
+    if interpolation is None:
+        interpolation = transforms.InterpolationMode.NEAREST
+
     if isinstance(transform, transforms.Compose):
         # Iterate through each transform in the Compose
         new_transforms = []
@@ -1304,6 +1830,8 @@ def torch_prefix_autoset(
 
 ##
 def grey_tensor_to_pil(some_tensor, *, colormap="viridis", normalize_p=True):
+    import matplotlib.pyplot as plt
+
     # Ensure the tensor is on CPU
     some_tensor = some_tensor.detach().cpu()
 
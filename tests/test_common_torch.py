@@ -0,0 +1,279 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+common_torch = pytest.importorskip("pynight.common_torch")
+
+from pynight.common_torch import (
+    drop_tokens,
+    hash_tensor,
+    hash_tensor_fold,
+    prepend_value,
+)
+
+cuda_only = pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="CUDA is not available"
+)
+
+#: 2 MiB of float32, i.e., an even number of 8 KiB fold rows
+n_big = 2**19
+
+
+def test_hash_tensor_fold_constant_tensors_differ():
+    folds = [
+        hash_tensor_fold(torch.zeros(n_big)),
+        hash_tensor_fold(torch.ones(n_big)),
+        hash_tensor_fold(torch.full((n_big,), 3.7)),
+    ]
+
+    for i in range(len(folds)):
+        for j in range(i + 1, len(folds)):
+            assert not torch.equal(folds[i], folds[j])
+
+
+def test_hash_tensor_fold_row_order_matters():
+    x = torch.arange(n_big, dtype=torch.float32).view(-1, 2048)
+    #: each row is 8 KiB
+    swapped = x[[1, 0, *range(2, x.shape[0])]]
+
+    assert not torch.equal(hash_tensor_fold(x), hash_tensor_fold(swapped))
+
+
+def test_hash_tensor_fold_storage_offset():
+    x = torch.ones(n_big + 1)
+
+    assert torch.equal(hash_tensor_fold(x[1:]), hash_tensor_fold(x[1:].clone()))
+
+
+def test_hash_tensor_fold_block_rows_invariant(monkeypatch):
+    x = torch.arange(n_big + 3, dtype=torch.float32)
+    expected = hash_tensor_fold(x)
+
+    monkeypatch.setattr(common_torch, "hash_tensor_fold_block_rows", 3)
+
+    assert torch.equal(hash_tensor_fold(x), expected)
+
+
+def test_hash_tensor_cpu_matches_raw_bytes():
+    x = torch.arange(10, dtype=torch.float32)
+
+    assert hash_tensor(x) == hashlib.sha256(x.numpy().tobytes()).hexdigest()
+
+
+@cuda_only
+def test_hash_tensor_cuda_default_matches_cpu():
+    x = torch.arange(n_big, dtype=torch.float32)
+
+    assert hash_tensor(x.cuda()) == hash_tensor(x)
+
+
+@cuda_only
+def test_hash_tensor_device_fold_constant_tensors_differ():
+    digests = {
+        hash_tensor(torch.zeros(n_big, device="cuda"), device_fold_p=True),
+        hash_tensor(torch.ones(n_big, device="cuda"), device_fold_p=True),
+        hash_tensor(torch.full((n_big,), 3.7, device="cuda"), device_fold_p=True),
+    }
+
+    assert len(digests) == 3
+
+
+@cuda_only
+def test_hash_tensor_device_fold_storage_offset():
+    x = torch.ones(n_big + 1, device="cuda")
+
+    assert hash_tensor(x[1:], device_fold_p=True) == hash_tensor(
+        x[1:].clone(), device_fold_p=True
+    )
+
+
+@cuda_only
+def test_pinned_pool_uses_size_classes():
+    common_torch.pinned_pool_clear()
+
+    for nbytes in (3000, 3500, 4096):
+        with common_torch.pinned_buffer_acquire(nbytes) as buffer:
+            assert buffer.numel() == nbytes
+
+    assert list(common_torch._PINNED_POOL.keys()) == [4096]
+    assert len(common_torch._PINNED_POOL[4096]) == 1
+
+
+def test_prepend_value_scalar():
+    x = torch.tensor([[2, 2, 3], [4, 5, 6]])
+
+    assert prepend_value(x, 33).tolist() == [[33, 2, 2, 3], [33, 4, 5, 6]]
+
+
+def test_prepend_value_large_int_is_exact():
+    value = 2**53 + 1
+    x = torch.zeros((2, 3), dtype=torch.int64)
+
+    assert prepend_value(x, value)[:, 0].tolist() == [value, value]
+
+
+def test_prepend_value_complex_scalar():
+    x = torch.zeros((2, 3), dtype=torch.complex64)
+
+    assert prepend_value(x, 1 + 2j)[:, 0].tolist() == [1 + 2j, 1 + 2j]
+
+
+def test_prepend_value_numpy_large_int_is_exact():
+    value = np.int64(2**53 + 1)
+    x = torch.zeros((2, 3), dtype=torch.int64)
+
+    assert prepend_value(x, value)[:, 0].tolist() == [int(value), int(value)]
+
+
+def test_prepend_value_overflow_raises():
+    x = torch.zeros((2, 3), dtype=torch.float16)
+
+    with pytest.raises(RuntimeError):
+        prepend_value(x, 1e6)
+
+
+def test_torch_benchmarker_cpu_device():
+    output = dict()
+    with common_torch.TorchBenchmarker(output_dict=output, device="cpu"):
+        torch.ones(10).sum()
+
+    assert output["time_total"] >= 0
+    assert "max_memory_allocated" not in output
+
+
+def test_drop_tokens_non_bool_mask():
+    tokens = torch.arange(2 * 5 * 3).view(2, 5, 3)
+    mask = torch.tensor([[256, 0, 0, 2], [0, 0.5, 7, 0]])
+
+    expected = torch.stack(
+        (tokens[0, [0, 1, 4]], tokens[1, [0, 2, 3]]),
+    )
+
+    assert torch.equal(drop_tokens(tokens, mask, num_prefix_tokens=1), expected)
+
+
+def test_drop_tokens_unordered():
+    tokens = torch.arange(2 * 5 * 3).view(2, 5, 3)
+    mask = torch.tensor([[1, 0, 0, 1], [0, 1, 1, 0]])
+
+    res = drop_tokens(tokens, mask, num_prefix_tokens=1, ordered=False)
+
+    assert torch.equal(res[:, 0], tokens[:, 0])
+    for b, kept in enumerate(([1, 4], [2, 3])):
+        assert sorted(res[b, 1:].tolist()) == tokens[b, kept].tolist()
+
+
+def test_drop_tokens_compiled():
+    tokens = torch.randn(2, 5, 3)
+    mask = torch.tensor([[1, 0, 0, 1], [0, 1, 1, 0]])
+
+    for num_prefix_tokens in (0, 1):
+        m = mask if num_prefix_tokens else torch.cat((mask, mask[:, :1]), dim=1)
+
+        expected = drop_tokens(tokens, m, num_prefix_tokens=num_prefix_tokens)
+        res = drop_tokens(
+            tokens, m, num_prefix_tokens=num_prefix_tokens, compile_p=True
+        )
+
+        assert torch.equal(res, expected)
+
+
+def test_drop_tokens_check_mask():
+    tokens = torch.arange(2 * 5 * 3).view(2, 5, 3)
+    mask = torch.tensor([[1, 0, 0, 1], [0, 1, 1, 1]])
+
+    with pytest.raises(ValueError):
+        drop_tokens(tokens, mask, num_prefix_tokens=1, check_mask_p=True)
+
+
+@cuda_only
+def test_drop_tokens_mask_on_other_device():
+    tokens = torch.arange(2 * 5 * 3).view(2, 5, 3)
+    mask = torch.tensor([[1, 0, 0, 1], [0, 1, 1, 0]])
+
+    expected = drop_tokens(tokens, mask, num_prefix_tokens=1)
+
+    assert torch.equal(
+        drop_tokens(tokens.cuda(), mask, num_prefix_tokens=1).cpu(), expected
+    )
+    assert torch.equal(drop_tokens(tokens, mask.cuda(), num_prefix_tokens=1), expected)
+
+
+def test_model_device_get_after_to_empty():
+    model = torch.nn.Linear(2, 2, device="meta")
+    assert common_torch.model_device_get(model).type == "meta"
+
+    model.to_empty(device="cpu")
+    assert common_torch.model_device_get(model).type == "cpu"
+
+
+def test_model_device_get_without_parameters():
+    assert common_torch.model_device_get(torch.nn.ReLU()) == torch.device("cpu")
+
+
+def test_torch_model_mode_sets_submodules():
+    model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Dropout())
+    model.eval()
+    model[1].train()
+
+    with common_torch.TorchModelMode(model, "eval"):
+        assert not model[1].training
+
+    assert not model.training
+
+
+def test_torch_shape_get_plain_tree():
+    res = common_torch.torch_shape_get(
+        {"a": torch.zeros(2, 3), "b": [torch.ones(1), 3, None]},
+        device_p=False,
+    )
+
+    assert res["a"].to_dict() == dict(dtype="torch.float32", shape=(2, 3))
+    assert res["b"][0].shape == torch.Size([1])
+    assert res["b"][1:] == [3, None]
+
+
+def test_torch_shape_get_opaque_leaves():
+    res = common_torch.torch_shape_get({"a": np.zeros(3), "b": object}, device_p=False)
+
+    assert res["a"].dtype == np.zeros(3).dtype
+    assert res["b"] is object
+
+
+def test_torch_shape_get_state_dict():
+    from collections import OrderedDict, namedtuple
+
+    sd = torch.nn.Linear(4, 2).state_dict()
+    assert isinstance(sd, OrderedDict)
+
+    res = common_torch.torch_shape_get(sd, size_p=True, device_p=False)
+
+    assert isinstance(res["tree"], OrderedDict)
+    assert res["tree"]["weight"].size_mb == 4 * 2 * 4 / 2**20
+    assert res["tree"]["weight"].device is None
+    assert res["total_size_mb"] == (4 * 2 + 2) * 4 / 2**20
+
+    Pair = namedtuple("Pair", ["a", "b"])
+    res = common_torch.torch_shape_get(Pair(torch.zeros(1), 3), device_p=False)
+
+    assert isinstance(res, Pair)
+    assert res.a.shape == torch.Size([1])
+    assert res.b == 3
+
+
+def test_torch_shape_get_to_dict_json():
+    import json
+
+    res = common_torch.torch_shape_get(
+        {"a": torch.zeros(2, 3, dtype=torch.float16)}, size_p=True
+    )
+    info = res["tree"]["a"].to_dict()
+
+    assert json.loads(json.dumps(info)) == dict(
+        dtype="torch.float16",
+        shape=[2, 3],
+        device="cpu",
+        size_mb=2 * 3 * 2 / 2**20,
+    )